@@ -0,0 +1,428 @@
+"""
+enhance_estimate 系ハンドラ共通のヘルパー。
+
+function_app.py（v2モデル）と enhance_estimate/__init__.py（レガシーモデル）で
+重複していた実装を一元化する。性能系の修正はここ1箇所に入れれば両方へ効く。
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import orjson
+
+
+@dataclass(frozen=True)
+class _Config:
+    """
+    環境変数を起動時に一度だけ読み込む。リクエスト毎の os.getenv を排し、
+    設定欠落をコールドスタート時点で確定させる。
+    """
+
+    openai_key: str | None = os.getenv("OPENAI_API_KEY")
+    openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+    gemini_key: str | None = os.getenv("GEMINI_API_KEY")
+    gemini_model: str = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+
+
+_CFG = _Config()
+
+# レスポンスヘッダは不変なのでリクエスト毎に生成しない
+_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+# プロバイダ呼び出し1回あたりの上限秒数
+_PROVIDER_TIMEOUT = float(os.getenv("LLM_PROVIDER_TIMEOUT", "8.0"))
+
+
+def _clamp(x: float, lo: float, hi: float) -> float:
+    return max(lo, min(hi, x))
+
+
+def _safe_int(x, default=0) -> int:
+    try:
+        return int(x)
+    except Exception:
+        return default
+
+
+_OPEN_BRACE = re.compile(r"\{")
+
+# JSON5パーサは厳密パーサの数百倍遅いため、救済を試みる入力サイズを絞る
+_JSON5_MAX_LEN = 64 * 1024
+
+
+def _json5_fallback(text: str) -> dict | None:
+    """
+    末尾カンマ・引用符なしキー・コードフェンス等の軽微な崩れをJSON5として救済する。
+    低速なので厳密パースが失敗したときの最後の手段。救済できなければ None。
+    """
+    if len(text) >= _JSON5_MAX_LEN:
+        return None
+    try:
+        import pyjson5
+    except ImportError:
+        return None
+
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        lines = cleaned.splitlines()
+        if lines and lines[0].startswith("```"):
+            lines = lines[1:]
+        if lines and lines[-1].strip().startswith("```"):
+            lines = lines[:-1]
+        cleaned = "\n".join(lines)
+    try:
+        out = pyjson5.loads(cleaned)
+    except Exception:
+        return None
+    if isinstance(out, dict):
+        logging.warning("json5_fallback_used")
+        return out
+    return None
+
+
+def _extract_json(text: str) -> dict:
+    """
+    LLMが余計なテキストを混ぜても、最初のJSONオブジェクトだけ抜き出す。
+
+    貪欲正規表現はバックトラックでO(n^2)になるため、1パスの括弧対応で走査する。
+    厳密パースに失敗した場合のみJSON5で救済を試みる。
+    """
+    # 素直にJSONだけが返ってきた場合は走査せずそのままパース
+    stripped = text.strip()
+    if stripped.startswith("{") and stripped.endswith("}"):
+        try:
+            return orjson.loads(stripped)
+        except json.JSONDecodeError:
+            pass
+
+    m = _OPEN_BRACE.search(text)
+    if not m:
+        raise ValueError("No JSON object found in model output")
+    start = m.start()
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                candidate = text[start : i + 1]
+                try:
+                    return orjson.loads(candidate)
+                except json.JSONDecodeError:
+                    out = _json5_fallback(candidate)
+                    if out is not None:
+                        return out
+                    raise
+    # 括弧が閉じない＝構文が崩れている。JSON5で最後の救済を試みる
+    out = _json5_fallback(text)
+    if out is not None:
+        return out
+    raise ValueError("No JSON object found in model output")
+
+
+# 出力契約。プロンプトの自然言語で説明する代わりにプロバイダのスキーマ強制へ渡す
+_ADJUSTMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "multiplier_suggestion": {"type": "number"},
+        "reasons": {"type": "array", "items": {"type": "string"}},
+        "rationale_md": {"type": "string"},
+        "added_warnings": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["multiplier_suggestion", "reasons", "rationale_md", "added_warnings"],
+    "additionalProperties": False,
+}
+
+# Gemini の response_schema は additionalProperties を受け付けず、SDKが
+# ネットワークI/O前に ValueError で拒否する。同じ契約から当該キーを除いた版を渡す
+_GEMINI_ADJUSTMENT_SCHEMA = {
+    k: v for k, v in _ADJUSTMENT_SCHEMA.items() if k != "additionalProperties"
+}
+
+# OpenAI structured outputs 用の response_format
+_OPENAI_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "adjustment", "schema": _ADJUSTMENT_SCHEMA, "strict": True},
+}
+
+
+class _JsonStreamScanner:
+    """
+    ストリーミング出力を逐次走査し、最初のJSONオブジェクトが閉じた時点を検出する。
+    閉じた時点で残りのチャンクを待たずにパースへ進める（体感レイテンシ短縮）。
+    """
+
+    def __init__(self) -> None:
+        self._parts: list[str] = []
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def feed(self, chunk: str) -> bool:
+        """チャンクを追加し、最初のオブジェクトが完結したら True を返す。"""
+        if self.done:
+            return True
+        self._parts.append(chunk)
+        for c in chunk:
+            if not self._started:
+                if c == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                self._depth += 1
+            elif c == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                    return True
+        return False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+
+@functools.lru_cache(maxsize=1)
+def _openai_client():
+    # SDKはhttpx/pydanticを引き込み数百msかかるため、コールドスタート短縮のため初回利用時にimport
+    import httpx
+    from openai import AsyncOpenAI
+
+    # プロセスで1クライアントとし、ウォーム起動間で接続プールを共有する。
+    # 無制限に待たせない：接続2s・読み取り8s・リトライは1回まで
+    return AsyncOpenAI(
+        api_key=_CFG.openai_key,
+        timeout=httpx.Timeout(connect=2.0, read=8.0, write=5.0, pool=2.0),
+        max_retries=1,
+    )
+
+
+async def _parse_streamed_json(text: str) -> dict:
+    """ストリームから取り出したテキストをdictへパースする。"""
+    try:
+        return orjson.loads(text)
+    except json.JSONDecodeError:
+        if len(text) > 100_000:
+            # 異常に長い応答の走査でイベントループを塞がない
+            return await asyncio.to_thread(_extract_json, text)
+        return _extract_json(text)
+
+
+async def _openai_stream_json(model: str, system: str, user_json: dict) -> dict:
+    """OpenAIへストリーミングで問い合わせ、最初のJSONオブジェクトをパースして返す。"""
+    client = _openai_client()
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user", "content": orjson.dumps(user_json).decode()},
+        ],
+        temperature=0.2,
+        response_format=_OPENAI_RESPONSE_FORMAT,
+        stream=True,
+    )
+    # 最初のJSONオブジェクトが閉じた時点で残りを待たずにパースする
+    scanner = _JsonStreamScanner()
+    async for chunk in stream:
+        piece = chunk.choices[0].delta.content if chunk.choices else None
+        if piece and scanner.feed(piece):
+            break
+    await stream.close()
+    return await _parse_streamed_json(scanner.text)
+
+
+# 同一入力に対するLLM応答キャッシュ（ウォームインスタンス内で有効）。
+# 無制限に成長させず、上限超過時は最も使われていないエントリから追い出す
+_LLM_CACHE: OrderedDict = OrderedDict()
+_LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+_LLM_CACHE_MAX = int(os.getenv("LLM_CACHE_MAX", "1024"))
+
+
+def _cache_key(model: str, system: str, user_json: dict) -> str:
+    raw = json.dumps([model, system, user_json], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _redis_client():
+    # REDIS_URL が設定されていればインスタンス間で共有するキャッシュを使う
+    url = os.getenv("REDIS_URL")
+    if not url:
+        return None
+    try:
+        import redis
+
+        return redis.Redis.from_url(url)
+    except Exception:
+        logging.warning("redis_cache_unavailable")
+        return None
+
+
+def _cache_get(key: str):
+    hit = _LLM_CACHE.get(key)
+    if hit is not None:
+        expires_at, value = hit
+        if time.time() < expires_at:
+            _LLM_CACHE.move_to_end(key)
+            return value
+        _LLM_CACHE.pop(key, None)
+    r = _redis_client()
+    if r is not None:
+        try:
+            raw = r.get(key)
+            if raw:
+                return json.loads(raw)
+        except Exception:
+            logging.warning("redis_cache_get_failed")
+    return None
+
+
+def _cache_put(key: str, value: dict) -> None:
+    _LLM_CACHE[key] = (time.time() + _LLM_CACHE_TTL, value)
+    _LLM_CACHE.move_to_end(key)
+    while len(_LLM_CACHE) > _LLM_CACHE_MAX:
+        _LLM_CACHE.popitem(last=False)
+    r = _redis_client()
+    if r is not None:
+        try:
+            r.set(key, json.dumps(value, ensure_ascii=False), ex=_LLM_CACHE_TTL)
+        except Exception:
+            logging.warning("redis_cache_set_failed")
+
+
+# 同一キーの同時呼び出しを1本のAPI呼び出しに束ねる（キャッシュスタンピード対策）
+_INFLIGHT: dict[str, asyncio.Task] = {}
+_INFLIGHT_LOCK = asyncio.Lock()
+
+
+async def _run_inflight(key: str, call):
+    try:
+        return await call()
+    finally:
+        async with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+
+async def _single_flight(key: str, call):
+    """同一キーの呼び出しが進行中なら、その結果を待って相乗りする。"""
+    async with _INFLIGHT_LOCK:
+        task = _INFLIGHT.get(key)
+        if task is None:
+            # 呼び出し本体は独立タスクで走らせ、shield で待つ。待ち手の1つが
+            # キャンセルされても（wait_for のタイムアウト等）本体と他の相乗りへ
+            # 波及させない
+            task = asyncio.get_running_loop().create_task(_run_inflight(key, call))
+            # 全待ち手が先に脱落した場合の未回収例外警告を抑止
+            task.add_done_callback(lambda t: None if t.cancelled() else t.exception())
+            _INFLIGHT[key] = task
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            # 共有タスク側が中断された場合は、呼び出し元の except Exception で
+            # 拾える通常例外へ読み替える
+            raise RuntimeError("in-flight LLM call was cancelled") from None
+        raise
+
+
+def _should_short_circuit(payload: dict, model: str) -> dict | None:
+    """
+    明らかに調整不能・無意味な入力はLLMを呼ばず係数1.00で即応する（低コストガード）。
+    該当しなければ None。
+    """
+    summary = (payload.get("summary") or "").strip()
+    scope = (payload.get("scope") or "").strip()
+    core_result = payload.get("core_result") or {}
+    estimated_amount = _safe_int(core_result.get("estimated_amount"), 0)
+    currency = (core_result.get("currency") or "JPY").strip()
+    breakdown = core_result.get("breakdown") or {}
+
+    warnings = []
+    if len(summary) < 30:
+        warnings.append("summary が短すぎます（30文字未満）")
+    if len(scope) < 30:
+        warnings.append("scope が短すぎます（30文字未満）")
+    if not breakdown:
+        warnings.append("core_result.breakdown が空です")
+    if currency != "JPY":
+        warnings.append(f"JPY以外の通貨（{currency}）は係数調整の対象外です")
+    if estimated_amount > 10**12:
+        warnings.append("estimated_amount が異常に大きいため入力を確認してください")
+    if not warnings:
+        return None
+
+    return {
+        "status": "ok",
+        "adjustment": {
+            "multiplier": 1.0,
+            "amount_delta": 0,
+            "adjusted_amount": estimated_amount,
+            "reasons": ["入力情報が不足しているため、乗数は1.00に固定しました。"],
+        },
+        "rationale_md": "入力不足により係数調整は行いません。必要情報（要約・範囲）をご提供ください。",
+        "added_warnings": warnings,
+        "disclaimer": "本結果は入力内容に基づく補助的な提案です。",
+        "model": model,
+    }
+
+
+def _minify_for_llm(payload: dict) -> dict:
+    """
+    LLMへ渡す入力を必要最小限へ射影する（プリフィルトークン削減）。
+    breakdown の配列は合計値へ畳み、長文は1500文字で打ち切る。
+    """
+    core_result = payload.get("core_result") or {}
+    breakdown = core_result.get("breakdown") or {}
+    if isinstance(breakdown, dict):
+        breakdown = {
+            k: sum(v) if isinstance(v, list) and all(isinstance(i, (int, float)) for i in v) else v
+            for k, v in breakdown.items()
+        }
+    # dict以外（配列等）の形状はベースライン同様そのまま渡す
+    return {
+        "project_name": (payload.get("project_name") or "").strip(),
+        "summary": (payload.get("summary") or "").strip()[:1500],
+        "scope": (payload.get("scope") or "").strip()[:1500],
+        "core_result": {
+            "estimated_amount": _safe_int(core_result.get("estimated_amount"), 0),
+            "currency": (core_result.get("currency") or "JPY").strip(),
+            "breakdown": breakdown,
+        },
+    }
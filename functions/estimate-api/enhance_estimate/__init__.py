@@ -1,136 +1,133 @@
-import json
-import os
-import re
+import asyncio
+import logging
 
 import azure.functions as func
-
-# OpenAI SDK v1
-from openai import OpenAI
-
-
-def _cors_headers() -> dict:
-    return {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type",
-    }
-
-
-def _clamp(x: float, lo: float, hi: float) -> float:
-    return max(lo, min(hi, x))
-
-
-def _safe_int(x, default=0) -> int:
-    try:
-        return int(x)
-    except Exception:
-        return default
-
-
-def _extract_json(text: str) -> dict:
-    """
-    LLMが余計なテキストを混ぜても、最初のJSONオブジェクトだけ抜き出す。
-    """
-    m = re.search(r"\{.*\}", text, re.DOTALL)
-    if not m:
-        raise ValueError("No JSON object found in model output")
-    return json.loads(m.group(0))
-
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
+import orjson
+
+from _common import (
+    _CFG,
+    _CORS_HEADERS,
+    _PROVIDER_TIMEOUT,
+    _cache_get,
+    _cache_key,
+    _cache_put,
+    _clamp,
+    _minify_for_llm,
+    _openai_stream_json,
+    _safe_int,
+    _should_short_circuit,
+    _single_flight,
+)
+
+# The schema is enforced server-side via structured outputs; the prompt only
+# carries the judgement rules
+_SYSTEM_PROMPT = (
+    "You are an estimation assistant. Suggest a multiplier (1.00 to 1.30; "
+    "1.00 if information is insufficient). reasons are short Japanese "
+    "sentences; rationale_md is concise business-friendly Japanese Markdown."
+)
+
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     # CORS preflight
     if req.method == "OPTIONS":
-        return func.HttpResponse("", status_code=204, headers=_cors_headers())
+        return func.HttpResponse("", status_code=204, headers=_CORS_HEADERS)
 
     try:
         payload = req.get_json()
     except Exception:
         return func.HttpResponse(
-            json.dumps({"status": "error", "message": "Invalid JSON"}),
+            orjson.dumps({"status": "error", "message": "Invalid JSON"}),
             status_code=400,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
 
-    project_name = (payload.get("project_name") or "").strip()
-    summary = (payload.get("summary") or "").strip()
-    scope = (payload.get("scope") or "").strip()
     core_result = payload.get("core_result") or {}
-
     estimated_amount = _safe_int(core_result.get("estimated_amount"), 0)
-    currency = (core_result.get("currency") or "JPY").strip()
-    breakdown = core_result.get("breakdown") or {}
-    warnings = core_result.get("warnings") or []
-    assumptions = core_result.get("assumptions") or []
-    config_version = core_result.get("config_version")
 
     if estimated_amount <= 0:
         return func.HttpResponse(
-            json.dumps({"status": "error", "message": "core_result.estimated_amount is required"}),
+            orjson.dumps(
+                {"status": "error", "message": "core_result.estimated_amount is required"}
+            ),
             status_code=400,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
 
     # OpenAI settings
-    api_key = os.getenv("OPENAI_API_KEY")
-    model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+    api_key = _CFG.openai_key
+    model = _CFG.openai_model
+
+    # Execution-avoidance guard: degenerate inputs never touch the network
+    short = _should_short_circuit(payload, model)
+    if short is not None:
+        return func.HttpResponse(
+            orjson.dumps(short),
+            status_code=200,
+            mimetype="application/json",
+            headers=_CORS_HEADERS,
+        )
 
     if not api_key:
         return func.HttpResponse(
-            json.dumps({"status": "error", "message": "OPENAI_API_KEY is not set"}),
+            orjson.dumps({"status": "error", "message": "OPENAI_API_KEY is not set"}),
             status_code=500,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
 
-    client = OpenAI(api_key=api_key)
-
-    # Prompt: JSON only, suggest multiplier 1.00-1.30
-    system = (
-        "You are an estimation assistant. "
-        "Return ONLY valid JSON. No markdown, no extra text. "
-        "Your job: suggest a multiplier (1.00 to 1.30) and concise reasons, plus rationale_md.\n"
-        "Rules:\n"
-        "- If information is insufficient, set multiplier_suggestion to 1.00.\n"
-        "- Reasons must be short Japanese sentences.\n"
-        "- rationale_md must be short and explainable for business.\n"
-        "- added_warnings is optional.\n"
-        "Output schema:\n"
-        "{"
-        '"multiplier_suggestion": number,'
-        '"reasons": string[],'
-        '"rationale_md": string,'
-        '"added_warnings": string[]'
-        "}"
-    )
+    system = _SYSTEM_PROMPT
 
-    user = {
-        "project_name": project_name,
-        "summary": summary,
-        "scope": scope,
-        "core_result": {
-            "estimated_amount": estimated_amount,
-            "currency": currency,
-            "breakdown": breakdown,
-            "warnings": warnings,
-            "assumptions": assumptions,
-            "config_version": config_version,
-        },
-    }
+    # Send the model a minimal projection of the payload only
+    user = _minify_for_llm(payload)
+    logging.info(
+        "llm_input_minified: %d -> %d bytes", len(orjson.dumps(payload)), len(orjson.dumps(user))
+    )
 
     try:
-        # chat.completions style
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": json.dumps(user, ensure_ascii=False)},
-            ],
-            temperature=0.2,
-        )
-        text = resp.choices[0].message.content or ""
-        out = _extract_json(text)
+        # Cache hit skips the API round-trip entirely
+        cache_key = _cache_key(model, system, user)
+        out = _cache_get(cache_key)
+        if out is None:
+
+            async def _invoke() -> dict:
+                # Streamed call shared with function_app; parsing starts at the
+                # closing brace instead of after full generation
+                parsed = await _openai_stream_json(model, system, user)
+                _cache_put(cache_key, parsed)
+                return parsed
+
+            # Identical concurrent requests share one API call; on provider
+            # failure degrade to a 1.00 multiplier instead of surfacing 502
+            try:
+                out = await asyncio.wait_for(
+                    _single_flight(cache_key, _invoke), timeout=_PROVIDER_TIMEOUT
+                )
+            except Exception as e:
+                logging.warning("llm_provider_failed: openai: %s", e)
+                body = {
+                    "status": "ok",
+                    "adjustment": {
+                        "multiplier": 1.0,
+                        "amount_delta": 0,
+                        "adjusted_amount": estimated_amount,
+                        "reasons": ["LLMが一時的に利用できないため、乗数は1.00に固定しました。"],
+                    },
+                    "rationale_md": "LLMプロバイダが応答しないため、係数調整は行っていません。時間をおいて再実行してください。",
+                    "added_warnings": ["LLM呼び出しに失敗しました"],
+                    "disclaimer": "本結果は入力内容に基づく補助的な提案です。",
+                    "model": model,
+                }
+                return func.HttpResponse(
+                    orjson.dumps(body),
+                    status_code=200,
+                    mimetype="application/json",
+                    headers=_CORS_HEADERS,
+                )
+        else:
+            logging.info("llm_cache_hit")
 
         mult = float(out.get("multiplier_suggestion", 1.0))
         mult = _clamp(mult, 1.0, 1.3)
@@ -157,18 +154,16 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         }
 
         return func.HttpResponse(
-            json.dumps(body, ensure_ascii=False),
+            orjson.dumps(body),
             status_code=200,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
 
     except Exception as e:
         return func.HttpResponse(
-            json.dumps(
-                {"status": "error", "message": f"LLM call failed: {str(e)}"}, ensure_ascii=False
-            ),
+            orjson.dumps({"status": "error", "message": f"LLM call failed: {str(e)}"}),
             status_code=502,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
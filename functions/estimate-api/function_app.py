@@ -1,10 +1,29 @@
-import json
+import asyncio
+import functools
+import hashlib
 import logging
 import os
-import re
 
 import azure.functions as func
-import google.generativeai as genai
+import orjson
+
+from _common import (
+    _CFG,
+    _CORS_HEADERS,
+    _GEMINI_ADJUSTMENT_SCHEMA,
+    _PROVIDER_TIMEOUT,
+    _cache_get,
+    _cache_key,
+    _cache_put,
+    _clamp,
+    _JsonStreamScanner,
+    _minify_for_llm,
+    _openai_stream_json,
+    _parse_streamed_json,
+    _safe_int,
+    _should_short_circuit,
+    _single_flight,
+)
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -22,7 +41,7 @@ def calculate_estimate(req: func.HttpRequest) -> func.HttpResponse:
         person_days = round(screen_count * 1.5 * m, 1)
 
         return func.HttpResponse(
-            json.dumps(
+            orjson.dumps(
                 {"screen_count": screen_count, "complexity": complexity, "person_days": person_days}
             ),
             mimetype="application/json",
@@ -30,37 +49,20 @@ def calculate_estimate(req: func.HttpRequest) -> func.HttpResponse:
         )
     except Exception as e:
         return func.HttpResponse(
-            json.dumps({"error": str(e)}), mimetype="application/json", status_code=400
+            orjson.dumps({"error": str(e)}), mimetype="application/json", status_code=400
         )
 
 
-def _cors_headers() -> dict:
-    return {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type",
-    }
-
-
-def _clamp(x: float, lo: float, hi: float) -> float:
-    return max(lo, min(hi, x))
-
-
-def _safe_int(x, default=0) -> int:
-    try:
-        return int(x)
-    except Exception:
-        return default
-
+# フォールバック（将来切替用ログ）
+if not os.getenv("GEMINI_MODEL"):
+    logging.info("model_fallback: GEMINI_MODEL not set -> using gemini-2.5-flash")
 
-def _extract_json(text: str) -> dict:
-    """
-    LLMが余計なテキストを混ぜても、最初のJSONオブジェクトだけ抜き出す。
-    """
-    m = re.search(r"\{.*\}", text, re.DOTALL)
-    if not m:
-        raise ValueError("No JSON object found in model output")
-    return json.loads(m.group(0))
+# スキーマはプロバイダ側で強制するため、プロンプトには判断基準だけ残す
+_SYSTEM_PROMPT = (
+    "あなたは見積支援のアシスタントです。出力は必ず日本語。\n"
+    "multiplier_suggestion は 1.00〜1.30、情報不足なら 1.00。\n"
+    "reasons は短い日本語の箇条書き、rationale_md はビジネス向けの簡潔な日本語Markdown。"
+)
 
 
 def _looks_english(s: str) -> bool:
@@ -71,93 +73,199 @@ def _looks_english(s: str) -> bool:
     return letters > 0 and (ascii_letters / letters) > 0.8
 
 
-def _call_gemini(system: str, user_json: dict) -> dict:
-    key = os.getenv("GEMINI_API_KEY")
-    desired_model = os.getenv("GEMINI_MODEL")
-    # フォールバック（将来切替用ログ）
-    if not desired_model:
-        desired_model = "gemini-2.5-flash"
-        logging.info("model_fallback: GEMINI_MODEL not set -> using gemini-2.5-flash")
+# genai.configure はプロセスで一度だけ。モデルもHTTP接続プールごと再利用する
+_GENAI_CONFIGURED = False
+_GEMINI_MODELS: dict = {}
+
+
+def _gemini_model(model_name: str, system: str, api_key: str):
+    # SDKはprotobuf等で数百msかかるため、コールドスタート短縮のため初回利用時にimport
+    import google.generativeai as genai
+
+    global _GENAI_CONFIGURED
+    if not _GENAI_CONFIGURED:
+        genai.configure(api_key=api_key)
+        _GENAI_CONFIGURED = True
+    key = (model_name, hashlib.sha256(system.encode("utf-8")).hexdigest())
+    model = _GEMINI_MODELS.get(key)
+    if model is None:
+        model = genai.GenerativeModel(model_name, system_instruction=system)
+        _GEMINI_MODELS[key] = model
+    return model
+
+
+async def _call_gemini(system: str, user_json: dict) -> dict:
+    key = _CFG.gemini_key
+    desired_model = _CFG.gemini_model
     if not key:
         raise RuntimeError("GEMINI_API_KEY not set")
 
-    genai.configure(api_key=key)
-    model = genai.GenerativeModel(desired_model, system_instruction=system)
-    resp = model.generate_content(
-        json.dumps(user_json, ensure_ascii=False),
-        generation_config={"temperature": 0.2, "response_mime_type": "application/json"},
-    )
-    return _extract_json(resp.text)
+    # キャッシュヒットならAPI呼び出しをスキップ
+    cache_key = _cache_key(desired_model, system, user_json)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        logging.info("llm_cache_hit")
+        return cached
 
+    async def _invoke() -> dict:
+        model = _gemini_model(desired_model, system, key)
+        stream = await model.generate_content_async(
+            orjson.dumps(user_json).decode(),
+            generation_config={
+                "temperature": 0.2,
+                "response_mime_type": "application/json",
+                "response_schema": _GEMINI_ADJUSTMENT_SCHEMA,
+            },
+            request_options={"timeout": _PROVIDER_TIMEOUT},
+            stream=True,
+        )
+        # 最初のJSONオブジェクトが閉じた時点でパースへ進む
+        scanner = _JsonStreamScanner()
+        async for chunk in stream:
+            try:
+                piece = chunk.text
+            except ValueError:
+                piece = ""
+            if piece and scanner.feed(piece):
+                break
+        out = await _parse_streamed_json(scanner.text)
+        _cache_put(cache_key, out)
+        return out
+
+    # 同一入力の同時リクエストはAPI呼び出しを共有する
+    return await _single_flight(cache_key, _invoke)
+
+
+async def _call_openai(system: str, user_json: dict) -> dict:
+    if not _CFG.openai_key:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    model = _CFG.openai_model
+
+    cache_key = _cache_key(model, system, user_json)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        logging.info("llm_cache_hit")
+        return cached
+
+    async def _invoke() -> dict:
+        out = await _openai_stream_json(model, system, user_json)
+        _cache_put(cache_key, out)
+        return out
+
+    return await _single_flight(cache_key, _invoke)
 
-@app.route(route="enhance_estimate", methods=["POST", "OPTIONS"])
-def enhance_estimate(req: func.HttpRequest) -> func.HttpResponse:
-    # CORS preflight
-    if req.method == "OPTIONS":
-        return func.HttpResponse("", status_code=204, headers=_cors_headers())
 
+# 優先プロバイダ（LLM_PRIMARY、既定: gemini）から順に試すフェイルオーバー。
+# 他のチューニング値と同様、順序は起動時に一度だけ確定させる
+_PROVIDER_CALLS = {"gemini": _call_gemini, "openai": _call_openai}
+_LLM_PRIMARY = os.getenv("LLM_PRIMARY", "gemini").lower()
+_PROVIDERS = [
+    (n, _PROVIDER_CALLS[n])
+    for n in [_LLM_PRIMARY, *(k for k in _PROVIDER_CALLS if k != _LLM_PRIMARY)]
+    if n in _PROVIDER_CALLS
+]
+
+
+def _provider_model(name: str) -> str:
+    return _CFG.openai_model if name == "openai" else _CFG.gemini_model
+
+
+@functools.lru_cache(maxsize=1)
+def _transient_errors() -> tuple:
+    """
+    フェイルオーバーで回復し得る一時的エラー型（レート制限・タイムアウト・API障害）。
+    SDKは遅延importのため、初回参照時に解決して以後キャッシュする。
+    """
+    errs: list[type] = [asyncio.TimeoutError, TimeoutError, ConnectionError]
     try:
-        payload = req.get_json()
-    except Exception:
-        return func.HttpResponse(
-            json.dumps({"status": "error", "message": "Invalid JSON"}),
-            status_code=400,
-            mimetype="application/json",
-            headers=_cors_headers(),
-        )
+        import httpx
+
+        errs.append(httpx.HTTPError)
+    except ImportError:
+        pass
+    try:
+        import openai
+
+        errs.append(openai.OpenAIError)
+    except ImportError:
+        pass
+    try:
+        from google.api_core import exceptions as gexc
+
+        errs += [gexc.GoogleAPICallError, gexc.RetryError]
+    except ImportError:
+        pass
+    return tuple(errs)
 
+
+async def _enhance_payload(payload: dict) -> tuple[dict, int]:
+    """
+    1件分の見積強化処理。(レスポンスbody, HTTPステータス) を返す。
+    単発・バッチ両ルートで共有する。
+    """
     core_result = payload.get("core_result") or {}
     estimated_amount = _safe_int(core_result.get("estimated_amount"), 0)
 
     if estimated_amount <= 0:
-        return func.HttpResponse(
-            json.dumps({"status": "error", "message": "core_result.estimated_amount is required"}),
-            status_code=400,
-            mimetype="application/json",
-            headers=_cors_headers(),
-        )
+        return {"status": "error", "message": "core_result.estimated_amount is required"}, 400
 
     # 入力不足判定（低コストガード）
-    summary = (payload.get("summary") or "").strip()
-    scope = (payload.get("scope") or "").strip()
-    if not summary or not scope:
-        mult = 1.0
-        adjusted_amount = int(estimated_amount * mult)
+    short = _should_short_circuit(payload, _CFG.gemini_model)
+    if short is not None:
+        return short, 200
+
+    system = _SYSTEM_PROMPT
+
+    # LLMには必要最小限の射影だけ渡す
+    user = _minify_for_llm(payload)
+    logging.info(
+        "llm_input_minified: %d -> %d bytes", len(orjson.dumps(payload)), len(orjson.dumps(user))
+    )
+
+    # 優先順にプロバイダを試し、一時的エラーのみ次へフェイルオーバー
+    out = None
+    used = None
+    degraded = False
+    config_errors: list[str] = []
+    for name, fn in _PROVIDERS:
+        try:
+            out = await asyncio.wait_for(fn(system, user), timeout=_PROVIDER_TIMEOUT)
+            used = name
+            break
+        except RuntimeError as e:
+            # APIキー未設定などの設定エラー。リトライでは回復しないため別枠で記録する
+            logging.warning("llm_provider_unconfigured: %s: %s", name, e)
+            config_errors.append(str(e))
+        except _transient_errors() as e:
+            logging.warning("llm_provider_failed: %s: %s", name, e)
+            degraded = True
+        except Exception as e:
+            # 想定外の失敗（実装バグ・SDK非互換等）は劣化応答で隠さず5xxで表面化させる
+            logging.exception("llm_provider_error: %s", name)
+            return {"status": "error", "message": f"LLM call failed: {e}"}, 502
+
+    if out is None:
+        if not degraded:
+            # 一時的障害ではなく全プロバイダが未設定。200で静かに劣化せず設定ミスとして返す
+            message = "; ".join(config_errors) or "no LLM provider configured"
+            return {"status": "error", "message": message}, 502
+        # 一時的障害で全プロバイダ失敗時は502ではなく係数1.00で穏やかに劣化させる
         body = {
             "status": "ok",
             "adjustment": {
                 "multiplier": 1.0,
-                "amount_delta": adjusted_amount - estimated_amount,
-                "adjusted_amount": adjusted_amount,
-                "reasons": ["入力情報が不足しているため、乗数は1.00に固定しました。"],
+                "amount_delta": 0,
+                "adjusted_amount": estimated_amount,
+                "reasons": ["LLMが一時的に利用できないため、乗数は1.00に固定しました。"],
             },
-            "rationale_md": "入力不足により係数調整は行いません。必要情報（要約・範囲）をご提供ください。",
-            "added_warnings": ["summary または scope が未入力です"],
+            "rationale_md": "LLMプロバイダが応答しないため、係数調整は行っていません。時間をおいて再実行してください。",
+            "added_warnings": ["LLM呼び出しが全プロバイダで失敗しました"],
             "disclaimer": "本結果は入力内容に基づく補助的な提案です。",
-            "model": os.getenv("GEMINI_MODEL", "gemini-2.5-flash"),
+            "model": "none",
         }
-        return func.HttpResponse(
-            json.dumps(body, ensure_ascii=False),
-            status_code=200,
-            mimetype="application/json",
-            headers=_cors_headers(),
-        )
-
-    system = (
-        "あなたは見積支援のアシスタントです。出力は必ず日本語で返してください。\n"
-        "返答は『有効なJSONのみ』。JSON以外の文字は一切出力しないでください。\n\n"
-        "制約:\n"
-        "- multiplier_suggestion は 1.00〜1.30 の範囲。\n"
-        "- 情報が不十分なら multiplier_suggestion は 1.00。\n"
-        "- reasons は短い日本語の箇条書き（配列）。\n"
-        "- rationale_md は日本語Markdownで、ビジネス向けに簡潔に。\n"
-        "- added_warnings は任意（日本語）。\n\n"
-        "出力スキーマ:\n"
-        '{\n  "multiplier_suggestion": number,\n  "reasons": string[],\n  "rationale_md": string,\n  "added_warnings": string[]\n}'
-    )
+        return body, 200
 
     try:
-        out = _call_gemini(system, payload)
         mult = _clamp(float(out.get("multiplier_suggestion", 1.0)), 1.0, 1.3)
         rationale_md = out.get("rationale_md") or ""
         # 英語率が高い場合は安全策で 1.00 に落としてテンプレに差し替え
@@ -181,22 +289,91 @@ def enhance_estimate(req: func.HttpRequest) -> func.HttpResponse:
             "rationale_md": rationale_md,
             "added_warnings": out.get("added_warnings") or [],
             "disclaimer": "本結果は入力内容に基づく補助的な提案です。",
-            "model": os.getenv("GEMINI_MODEL", "gemini-2.5-flash"),
+            "model": _provider_model(used),
         }
 
+        return body, 200
+
+    except Exception as e:
+        return {"status": "error", "message": f"LLM call failed: {str(e)}"}, 502
+
+
+@app.route(route="enhance_estimate", methods=["POST", "OPTIONS"])
+async def enhance_estimate(req: func.HttpRequest) -> func.HttpResponse:
+    # CORS preflight
+    if req.method == "OPTIONS":
+        return func.HttpResponse("", status_code=204, headers=_CORS_HEADERS)
+
+    try:
+        payload = req.get_json()
+    except Exception:
         return func.HttpResponse(
-            json.dumps(body, ensure_ascii=False),
-            status_code=200,
+            orjson.dumps({"status": "error", "message": "Invalid JSON"}),
+            status_code=400,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
 
-    except Exception as e:
+    body, status = await _enhance_payload(payload)
+    return func.HttpResponse(
+        orjson.dumps(body),
+        status_code=status,
+        mimetype="application/json",
+        headers=_CORS_HEADERS,
+    )
+
+
+# バッチ時の同時実行上限（トークン毎分制限に合わせて調整）
+_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", "20"))
+_BATCH_MAX_ITEMS = int(os.getenv("LLM_BATCH_MAX_ITEMS", "50"))
+
+
+@app.route(route="enhance_estimate_batch", methods=["POST", "OPTIONS"])
+async def enhance_estimate_batch(req: func.HttpRequest) -> func.HttpResponse:
+    # CORS preflight
+    if req.method == "OPTIONS":
+        return func.HttpResponse("", status_code=204, headers=_CORS_HEADERS)
+
+    try:
+        payload = req.get_json()
+    except Exception:
         return func.HttpResponse(
-            json.dumps(
-                {"status": "error", "message": f"LLM call failed: {str(e)}"}, ensure_ascii=False
-            ),
-            status_code=502,
+            orjson.dumps({"status": "error", "message": "Invalid JSON"}),
+            status_code=400,
             mimetype="application/json",
-            headers=_cors_headers(),
+            headers=_CORS_HEADERS,
         )
+
+    items = payload.get("items")
+    if not isinstance(items, list) or not items:
+        return func.HttpResponse(
+            orjson.dumps({"status": "error", "message": "items must be a non-empty array"}),
+            status_code=400,
+            mimetype="application/json",
+            headers=_CORS_HEADERS,
+        )
+    if len(items) > _BATCH_MAX_ITEMS:
+        return func.HttpResponse(
+            orjson.dumps({"status": "error", "message": f"items must be <= {_BATCH_MAX_ITEMS}"}),
+            status_code=400,
+            mimetype="application/json",
+            headers=_CORS_HEADERS,
+        )
+
+    # 同時実行を絞りつつ並列化。キャッシュ・単一飛行は1件ルートと共有
+    sem = asyncio.Semaphore(_BATCH_CONCURRENCY)
+
+    async def _one(p) -> dict:
+        if not isinstance(p, dict):
+            return {"status": "error", "message": "each item must be an object"}
+        async with sem:
+            body, _status = await _enhance_payload(p)
+            return body
+
+    results = await asyncio.gather(*[_one(p) for p in items])
+    return func.HttpResponse(
+        orjson.dumps({"status": "ok", "items": results}),
+        status_code=200,
+        mimetype="application/json",
+        headers=_CORS_HEADERS,
+    )